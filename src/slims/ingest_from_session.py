@@ -1,20 +1,90 @@
 from __future__ import annotations
 
 import abc
+import concurrent.futures
+import contextlib
+import functools
+import itertools
 import json
 import pathlib
 from typing import Iterable, Optional
 
 from typing_extensions import Literal
 import np_logging
+import sqlalchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from np_session.session import Session
 from np_session.components import SettingsXmlInfo, settings_xml_info_from_path
 
 import slims.tables as tables
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = np_logging.getLogger()
 
+def json_loads(data: bytes) -> list | dict:
+    """orjson when installed (parses in C, several times faster), stdlib json otherwise."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+@functools.lru_cache(maxsize=None)
+def neuropixels_version_from_probe_type(np_type: str) -> str:
+    """Map a probe type string from settings.xml to a `NeuropixelsVersion` enum value.
+
+    Only a handful of distinct type strings exist, so results are memoized rather
+    than re-scanning the enum per probe per session.
+    """
+    probe_types = tables.NeuropixelsProbe.NeuropixelsVersion.enums
+    return next((_ for _ in probe_types if _ in np_type), 'unknown')
+
+_settings_xml_cache: dict[tuple[pathlib.Path, int], SettingsXmlInfo] = {}
+
+def cached_settings_xml_info_from_path(path: str | pathlib.Path) -> SettingsXmlInfo:
+    """`settings_xml_info_from_path`, re-parsing only when the file's mtime changes.
+
+    Parsing includes hashing the xml, so repeat visits to a session (e.g. re-running
+    ingest after a partial failure) skip the network read entirely.
+    """
+    path = pathlib.Path(path)
+    key = (path, path.stat().st_mtime_ns)
+    if key not in _settings_xml_cache:
+        _settings_xml_cache[key] = settings_xml_info_from_path(path)
+    return _settings_xml_cache[key]
+
+def batch_settings_xml_info(paths: Iterable[str | pathlib.Path]) -> dict[pathlib.Path, SettingsXmlInfo]:
+    """Parse many settings.xml files across a process pool, warming the cache used by
+    `cached_settings_xml_info_from_path` so subsequent Dumpers get them for free.
+    """
+    paths = [pathlib.Path(p) for p in paths]
+    keys = [(path, path.stat().st_mtime_ns) for path in paths]
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        for key, info in zip(keys, pool.map(settings_xml_info_from_path, paths)):
+            _settings_xml_cache[key] = info
+    return {key[0]: _settings_xml_cache[key] for key in keys}
+
+def core_insert(model: type[tables.Base]) -> sqlalchemy.Insert:
+    """Core `INSERT` against the mapped table - skips ORM per-row processing."""
+    return model.__table__.insert()
+
+def upsert(model: type[tables.Base], row_keys: Iterable[str]) -> sqlalchemy.Insert:
+    """sqlite `INSERT ... ON CONFLICT DO UPDATE` for bulk-executing rows of `model`.
+
+    Only the columns in `row_keys` are updated on conflict: touching every table
+    column would null out values the rows don't supply.
+    """
+    stmt = sqlite_insert(model.__table__)
+    primary_keys = set(column.name for column in model.__table__.primary_key)
+    update_keys = set(row_keys) - primary_keys
+    if not update_keys:
+        return stmt.on_conflict_do_nothing(index_elements=sorted(primary_keys))
+    return stmt.on_conflict_do_update(
+        index_elements=sorted(primary_keys),
+        set_={key: stmt.excluded[key] for key in sorted(update_keys)},
+    )
+
 class Dumper(abc.ABC):
     
     probe_letter_to_metrics_csv: dict[str, pathlib.Path]
@@ -30,14 +100,17 @@ class Dumper(abc.ABC):
     """
     
     @abc.abstractmethod
-    def to_db(self, overwrite_existing: bool) -> None: ...
+    def to_db(self, overwrite_existing: bool, db_session: Optional[tables.Session] = None) -> None: ...
     
-    @property
+    @functools.cached_property
+    def metrics_csv_to_probe_letter(self) -> dict[pathlib.Path, str]:
+        return {v: k for k, v in self.probe_letter_to_metrics_csv.items()}
+
+    @functools.cached_property
     def probe_serial_number_to_letter(self) -> dict[int, str | None]:
         if self.settings_xml_info:
             return dict(zip(self.settings_xml_info.probe_serial_numbers, self.settings_xml_info.probe_letters))
-        metrics_csv_to_probe_letter = {v: k for k, v in self.probe_letter_to_metrics_csv.items()}
-        return {k: metrics_csv_to_probe_letter[v] for k, v in self.probe_serial_number_to_metrics_csv.items()}
+        return {k: self.metrics_csv_to_probe_letter[v] for k, v in self.probe_serial_number_to_metrics_csv.items()}
     
 class WithLims(Dumper):    
     
@@ -47,32 +120,32 @@ class WithLims(Dumper):
         
 class SqlAlchemy(WithLims, Dumper):
     
-    def __init__(self, session: str | pathlib.Path | Session) -> None:
-        
+    def __init__(self, session: str | pathlib.Path | Session, settings_xml_info: Optional[SettingsXmlInfo] = None) -> None:
+
         super().__init__(session)
-        
+
         self.probe_letter_to_metrics_csv = self.session.probe_letter_to_metrics_csv_path
         if not self.probe_letter_to_metrics_csv:
             raise ValueError(f'No metrics files available: {self.session!r}')
-        
-        settings_xml_path = self.session.find_settings_xml()
-        if not settings_xml_path:
-            raise ValueError(f'No settings.xml available: {self.session!r}')
-            
-        self.settings_xml_info = settings_xml_info_from_path(settings_xml_path)
+
+        if settings_xml_info is None:
+            # not pre-parsed for us (e.g. via `batch_settings_xml_info`): parse now
+            settings_xml_path = self.session.find_settings_xml()
+            if not settings_xml_path:
+                raise ValueError(f'No settings.xml available: {self.session!r}')
+            settings_xml_info = cached_settings_xml_info_from_path(settings_xml_path)
+        self.settings_xml_info = settings_xml_info
 
         self.probe_serial_number_to_metrics_csv = {
             serial_number: self.probe_letter_to_metrics_csv[letter]
             for serial_number, letter in self.probe_serial_number_to_letter.items() if letter
         }
-        rig = self.session.rig
-        
-    def to_db(self, overwrite_existing=True) -> None:
-        
-        lims = tables.LIMSEcephysSession(lims_id=self.session.id)
-        
-        probe_types = tables.NeuropixelsProbe.NeuropixelsVersion.enums
+        self.rig = self.session.rig.id if self.session.rig else None
+
+    def to_db(self, overwrite_existing=True, db_session: Optional[tables.Session] = None) -> None:
         
+        lims_row = dict(lims_id=self.session.id, folder=str(self.session.folder))
+
         if not self.settings_xml_info:
             raise ValueError(f'No settings.xml available: {self.session!r}')
             # it might be possible to get probe serial numbers from probe_info.json and
@@ -80,62 +153,93 @@ class SqlAlchemy(WithLims, Dumper):
         
         xml = self.settings_xml_info
         
-        rec = tables.Recording(
+        rec_row = dict(
             settings_xml_md5=xml.settings_xml_md5,
             lims_session_id=self.session.id,
             hostname=xml.hostname,
-            rig=self.session.rig.id if self.session.rig else None,
+            rig=self.rig,
             date=xml.date,
             start_time=xml.start_time,
             open_ephys_version=xml.open_ephys_version,
         )
         
-        probes = []
+        probe_rows = []
         for serial_number, np_type in zip(xml.probe_serial_numbers, xml.probe_types):
-            probes.append(
-                tables.NeuropixelsProbe(
+            probe_rows.append(
+                dict(
                     serial_number=serial_number,
-                    neuropixels_version=next((_ for _ in probe_types if _ in np_type), 'unknown'),
+                    neuropixels_version=neuropixels_version_from_probe_type(np_type),
                 )
             )
-        
-        sorted_probes = []
-        for serial_number, letter in self.probe_serial_number_to_letter.items():
-            sorted_probes.append(
-                tables.SortedProbeRecording(
+
+        # hashing the metrics csvs is I/O-bound on network storage: overlap them
+        csv_path_to_md5: dict[pathlib.Path, str] = {}
+        csv_paths = set(self.probe_serial_number_to_metrics_csv.values())
+        if csv_paths:    # may be empty if no probes could be assigned a letter
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(csv_paths))) as pool:
+                csv_path_to_md5 = dict(zip(csv_paths, pool.map(tables.md5, csv_paths)))
+
+        sorted_probe_rows = []
+        psn_to_letter = self.probe_serial_number_to_letter
+        for serial_number, letter in psn_to_letter.items():
+            sorted_probe_rows.append(
+                dict(
                     settings_xml_md5=xml.settings_xml_md5,
                     probe_serial_number=serial_number,
                     probe_letter=letter,
-                    metrics_csv_md5=tables.md5(self.probe_serial_number_to_metrics_csv[serial_number]),
+                    metrics_csv_md5=csv_path_to_md5[self.probe_serial_number_to_metrics_csv[serial_number]],
                 )
             )
-        
-        sorted_units = [
-            tables.SortedUnit.from_csv_path(
-                csv_path,       
-            ) for csv_path in self.probe_serial_number_to_metrics_csv.values()
-        ]
-        with tables.SESSION.no_autoflush as session:
-            
-            if overwrite_existing:
-                write = session.merge
-            else:
-                write = session.add
-                
-            write(lims)
-            write(rec)
-            
-            def rec_write(iterable: Iterable):
-                if not isinstance(iterable, Iterable):
-                    write(iterable)
-                else:
-                    for _ in iterable:
-                        rec_write(_)
-                        
-            for _ in (probes, sorted_probes, sorted_units):
-                rec_write(_)
+
+        sorted_unit_rows = list(
+            itertools.chain.from_iterable(
+                tables.SortedUnit.rows_from_csv_path(csv_path, metrics_csv_md5=csv_path_to_md5[csv_path])
+                for csv_path in self.probe_serial_number_to_metrics_csv.values()
+            )
+        )
+
+        # reuse a caller-provided session (one per ingest batch) rather than
+        # opening/closing a fresh one per np_session
+        with contextlib.ExitStack() as stack:
+            session = db_session or stack.enter_context(tables.get_session())
+            stack.enter_context(session.no_autoflush)
+
+            for model, rows in (
+                (tables.LIMSEcephysSession, [lims_row]),
+                (tables.Recording, [rec_row]),
+                (tables.NeuropixelsProbe, probe_rows),
+                (tables.SortedProbeRecording, sorted_probe_rows),
+            ):
+                if not rows:    # a statement with an empty parameter list is invalid sql
+                    continue
+                stmt = upsert(model, rows[0]) if overwrite_existing else core_insert(model)
+                session.execute(stmt, rows)
+            # units get a fresh uuid primary key on every insert, so there's nothing to upsert
+            if sorted_unit_rows:
+                session.execute(core_insert(tables.SortedUnit), sorted_unit_rows)
             session.commit()
             
+_db_session: Optional[tables.Session] = None
+
+def ingest(session, settings_xml_info: Optional[SettingsXmlInfo] = None) -> None:
+    global _db_session
+    if _db_session is None:
+        # one session per worker process, shared across its whole batch
+        _db_session = tables.get_session()
+    logger.info(f'Adding {session} to db...')
+    try:
+        d = SqlAlchemy(session, settings_xml_info=settings_xml_info)
+    except ValueError as exc:
+        logger.error('%r', exc)
+        return
+    try:
+        d.to_db(db_session=_db_session)
+    except Exception as exc:
+        # drop any pending statements so they can't leak into the commit of a
+        # later session sharing this db session
+        _db_session.rollback()
+        logger.exception(exc)
+
 if __name__ == '__main__':
     # d = SqlAlchemy('c:/1116941914_surface-image1-left.png')
     # d.to_db()
@@ -144,21 +248,27 @@ if __name__ == '__main__':
     # for probe in db.SESSION.scalars(stmt):
     #     print(probe)
     # # df = pd.read_sql_table('sorted_probe_recordings', db.ENGINE)
-    idx =0
-    for session in json.loads(pathlib.Path('sessions.json').read_bytes()):
-        # try:
-        logger.info(f'Adding {session} to db...')
+    sessions = json_loads(pathlib.Path('sessions.json').read_bytes())
+
+    # locate and pre-parse every settings.xml up front: the workers each have their
+    # own cache, so parsed infos are handed to them rather than re-parsed per worker
+    session_to_xml_path: dict = {}
+    for session in sessions:
         try:
-            d = SqlAlchemy(session)
+            path = Session(session).find_settings_xml()
         except ValueError as exc:
             logger.error('%r', exc)
-            continue
         else:
-            d.to_db()
-        #idx += 1
-        # if idx == 3:
-        #     break
-        # except Exception as exc:
-        #     logger.exception(exc)
-            
-    
\ No newline at end of file
+            if path:
+                session_to_xml_path[session] = pathlib.Path(path)
+    xml_infos = batch_settings_xml_info(session_to_xml_path.values())
+
+    # processes rather than threads: csv parsing and row-building are CPU-bound, and
+    # each worker gets its own engine/session (sqlite in WAL mode handles the writers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as pool:
+        for _ in pool.map(
+            ingest,
+            sessions,
+            (xml_infos.get(session_to_xml_path.get(session)) for session in sessions),
+        ):
+            pass
@@ -5,6 +5,8 @@ import csv
 import datetime
 import enum
 import hashlib
+import mmap
+import os
 import pathlib
 import sqlite3
 from collections.abc import Sequence
@@ -16,9 +18,14 @@ import np_config
 import numpy as np
 
 from sqlalchemy import (Column, Enum, ForeignKey, Identity, Integer, String, Table, Uuid,
-                        create_engine, select)
+                        create_engine, event, select)
 from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, relationship
-import pandas as pd
+import polars as pl
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # ------------------------------------------------------------------------------------
 # allow integers >8 bytes to be stored in sqlite3
@@ -29,9 +36,24 @@ sqlite3.register_adapter(np.int32, lambda val: int(val))
 DB_PATH = pathlib.Path("test.db")
 # with contextlib.suppress(OSError):
 #     DB_PATH.unlink()
-sqlite3.connect(DB_PATH).close()
 DB = f"sqlite:///{DB_PATH}"
-ENGINE = create_engine(DB, echo=False)
+# echo must stay off for bulk ingest (per-statement logging dominates runtime), and a
+# large insertmanyvalues page batches each executemany into few multi-VALUES statements
+ENGINE = create_engine(DB, echo=False, insertmanyvalues_page_size=10_000)
+
+@event.listens_for(ENGINE, "connect")
+def _set_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+    # WAL + NORMAL avoids an fsync per transaction during bulk ingest; temp
+    # tables/indices stay in memory and reads go through a 256 MiB mmap window
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # WAL still allows only one writer: parallel ingest workers must wait for the
+    # lock rather than raising 'database is locked' after sqlite3's 5 s default
+    cursor.execute("PRAGMA busy_timeout=60000")
+    cursor.close()
 
 
 class Base(DeclarativeBase):
@@ -179,23 +201,27 @@ class SortedUnit(Base):
     quality = mapped_column(Enum('good', 'noise', name='quality_enum'), nullable=True)
     
     @classmethod
-    def from_csv_path(cls, csv_path: pathlib.Path) -> tuple['SortedUnit', ...]:
+    def rows_from_csv_path(cls, csv_path: pathlib.Path, metrics_csv_md5: Optional[str] = None) -> list[dict]:
+        """One dict per unit in the metrics.csv, suitable for a bulk `insert()`."""
         csv_path = pathlib.Path(csv_path)
-        metrics_csv_md5 = md5(csv_path)
-        df = pd.read_csv(csv_path, index_col=0)
-        df = df.replace({np.nan:None})
-        # reader = csv.DictReader(csv_path.read_text(), cls.fieldnames)
-        return tuple(
-            cls(
+        if metrics_csv_md5 is None:
+            metrics_csv_md5 = md5(csv_path)
+        metrics_csv_path = np_config.normalize_path(csv_path).as_posix()
+        df = pl.scan_csv(csv_path).collect()
+        df = df.drop(df.columns[0])    # unlabelled index column
+        # nulls come out of polars as None - no nan replacement needed
+        return [
+            dict(
                 metrics_csv_md5=metrics_csv_md5,
-                metrics_csv_path=np_config.normalize_path(csv_path).as_posix(),
-                **{
-                    metric: df.loc[idx][metric]
-                    for metric in df.columns
-                },
-            )         
-            for idx in df.index
-        )
+                metrics_csv_path=metrics_csv_path,
+                **row,
+            )
+            for row in df.to_dicts()
+        ]
+
+    @classmethod
+    def from_csv_path(cls, csv_path: pathlib.Path) -> tuple['SortedUnit', ...]:
+        return tuple(cls(**row) for row in cls.rows_from_csv_path(csv_path))
         
     @classmethod
     def dummy(cls) -> SortedUnit:
@@ -247,10 +273,33 @@ class SortedProbeRecording(Base):
         return f"{self.__class__.__name__}({self.recording.rig or self.recording.hostname}_{self.recording.lims_session_id or '-no-lims-id'}_{self.recording.date:%Y%m%d}_probe{self.probe_letter})"
 
 def md5(path: str | pathlib.Path) -> str:
-    return hashlib.md5(pathlib.Path(path).read_bytes()).hexdigest()
+    # stream rather than read_bytes(): avoids holding whole file in memory, and
+    # file_digest releases the GIL while hashing so threaded callers overlap
+    with open(path, 'rb', buffering=0) as f:
+        return hashlib.file_digest(f, 'md5').hexdigest()
+
+USE_BLAKE3 = blake3 is not None
+"""Use blake3 (SIMD + multithreaded) for content fingerprints where we don't need to
+match md5 values already in the db."""
+
+def content_hash(path: str | pathlib.Path) -> str:
+    """Fingerprint of file contents - not interchangeable with `md5` values in existing columns."""
+    if not USE_BLAKE3:
+        return md5(path)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # cannot mmap an empty file
+            return blake3.blake3(b'').hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return blake3.blake3(mm, max_threads=blake3.blake3.AUTO).hexdigest()
 
-Base.metadata.create_all(ENGINE)
-SESSION = Session(ENGINE)
+def create_db() -> None:
+    """Create the sqlite file and any missing tables - idempotent."""
+    Base.metadata.create_all(ENGINE)
+
+def get_session() -> Session:
+    create_db()
+    return Session(ENGINE)
 
 if __name__ == "__main__":
 
@@ -273,8 +322,6 @@ if __name__ == "__main__":
     #     print(probe)
         
     
+    SESSION = get_session()
     tuple(SESSION.scalars(select(LIMSEcephysSession).where(NeuropixelsProbe.serial_number.in_([18005117142]))))
     tuple(SESSION.scalars(select(SortedUnit).outerjoin(SortedProbeRecording)))
-    
-    # requires pandas ver that doesn't support 3.7
-    df = pd.read_sql_table('sorted_units', DB, schema=None)